@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
+import os
+# Per-frame work is too small to gain from OpenMP/MKL threads, they would only
+# contend with the postprocessing thread. Must be set before importing cv2
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+
 import cv2
 import depthai as dai
 import numpy as np
+from numba import njit, prange
 import argparse
+import queue
+import threading
 import time
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import timedelta
 
 '''
 Blob taken from the great PINTO zoo
@@ -23,71 +33,92 @@ parser.add_argument("-shape", "--nn_shape", help="select NN model shape", defaul
 parser.add_argument("-nn", "--nn_path", help="select model path for inference", default='models/deeplab_v3_plus_mvn2_decoder_256_openvino_2021.2_6shave.blob', type=str)
 args = parser.parse_args()
 
+cv2.setNumThreads(1)
+cv2.setUseOptimized(True)
+
 # Custom JET colormap with 0 mapped to `black` - better disparity visualization
 jet_custom = cv2.applyColorMap(np.arange(256, dtype=np.uint8), cv2.COLORMAP_JET)
 jet_custom[0] = [0, 0, 0]
+# Same colormap as a plain (256, 3) lookup table, so it can be applied by indexing
+jet_lut = jet_custom.reshape(256, 3)
 
 nn_shape = args.nn_shape
 nn_path = args.nn_path
 TARGET_SHAPE = (400,400)
 
 def decode_deeplabv3p(output_tensor):
-    class_colors = [[0,0,0],  [0,255,0]]
-    class_colors = np.asarray(class_colors, dtype=np.uint8)
-
-    output = output_tensor.reshape(nn_shape,nn_shape)
-    output_colors = np.take(class_colors, output, axis=0)
-    return output_colors
-
-def get_multiplier(output_tensor):
-    class_binary = [[0], [1]]
-    class_binary = np.asarray(class_binary, dtype=np.uint8)
-    output = output_tensor.reshape(nn_shape,nn_shape)
-    output_colors = np.take(class_binary, output, axis=0)
-    return output_colors
+    # Only 2 classes (background, person), so the class ids are the mask
+    return output_tensor.reshape(nn_shape,nn_shape).astype(np.uint8, copy=False)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def postprocess(disp, mask, lut, frame, depth_color, cutout_color):
+    # Single pass over all pixels: colorize the disparity, cut it out with
+    # the mask and tint the masked (person) pixels of the frame green
+    for i in prange(disp.shape[0]):
+        for j in range(disp.shape[1]):
+            d = disp[i, j]
+            if mask[i, j]:
+                for c in range(3):
+                    depth_color[i, j, c] = lut[d, c]
+                    cutout_color[i, j, c] = lut[d, c]
+                g = frame[i, j, 1]
+                frame[i, j, 1] = 255 if g > 128 else g + 127
+            else:
+                for c in range(3):
+                    depth_color[i, j, c] = lut[d, c]
+                    cutout_color[i, j, c] = lut[0, c]
 
 class FPSHandler:
-    def __init__(self, cap=None):
-        self.timestamp = time.time()
-        self.start = time.time()
-        self.frame_cnt = 0
+    # FPS is averaged over the last `window` frames, so slowdowns are visible
+    def __init__(self, cap=None, window=30):
+        self.timestamps = deque(maxlen=window)
+        # Rasterized "Fps: X" text, only redrawn when the integer FPS changes
+        self._strip = np.zeros((16, 80, 3), dtype=np.uint8)
+        self._last_fps = None
     def next_iter(self):
-        self.timestamp = time.time()
-        self.frame_cnt += 1
+        self.timestamps.append(time.perf_counter())
     def fps(self):
-        return self.frame_cnt / (self.timestamp - self.start)
+        if len(self.timestamps) < 2:
+            return 0
+        return (len(self.timestamps) - 1) / (self.timestamps[-1] - self.timestamps[0])
+    def draw(self, frame):
+        fps = int(self.fps())
+        if fps != self._last_fps:
+            self._last_fps = fps
+            self._strip[:] = 0
+            cv2.putText(self._strip, "Fps: {}".format(fps), (2, self._strip.shape[0] - 4), cv2.FONT_HERSHEY_TRIPLEX, 0.4, color=(255, 255, 255))
+        # Stamp the text pixels into the bottom-left corner of the frame
+        np.copyto(frame[-self._strip.shape[0]:, :self._strip.shape[1]], self._strip, where=self._strip > 0)
 
 class HostSync:
-    def __init__(self):
-        self.arrays = {}
+    # 33ms since we add rgb/depth frames at 30FPS. If time difference between
+    # depth and the pass/nn pair is below 33ms, msgs are considered as synced
+    THRESHOLD = timedelta(milliseconds=33)
+    STREAMS = ("pass", "depth", "nn")
+
+    def __init__(self, maxlen=8):
+        # Only the last few msgs per stream are kept, so matching is O(1)
+        self.streams = {name: deque(maxlen=maxlen) for name in self.STREAMS}
     def add_msg(self, name, msg):
-        if not name in self.arrays:
-            self.arrays[name] = []
-        # Add msg to array
-        self.arrays[name].append({'msg': msg})
-        # Try finding synced msgs
-        ts = msg.getTimestamp()
-        synced = {}
-        for name, arr in self.arrays.items():
-            for i, obj in enumerate(arr):
-                time_diff = abs(obj['msg'].getTimestamp() - ts)
-                # 20ms since we add rgb/depth frames at 30FPS => 33ms. If
-                # time difference is below 20ms, it's considered as synced
-                if time_diff < timedelta(milliseconds=33):
-                    synced[name] = obj['msg']
-                    # print(f"{name}: {i}/{len(arr)}")
-                    break
-        # If there are 3 (all) synced msgs, remove all old msgs
-        # and return synced msgs
-        if len(synced) == 3: # color, depth, nn
-            def remove(t1, t2):
-                return timedelta(milliseconds=500) < abs(t1 - t2)
-            # Remove old msgs
-            for name, arr in self.arrays.items():
-                for i, obj in enumerate(arr):
-                    if remove(obj['msg'].getTimestamp(), ts):
-                        arr.remove(obj)
-                    else: break
+        self.streams[name].append(msg)
+        # pass/nn msgs come from the same frame, so pair them by sequence
+        # number first. Depth comes from different (not synced) cameras, so it
+        # is matched to the pair by the closest timestamp
+        passthrough = {m.getSequenceNum(): m for m in self.streams["pass"]}
+        for nn in reversed(self.streams["nn"]): # Newest pair first
+            frame = passthrough.get(nn.getSequenceNum())
+            if frame is None or not self.streams["depth"]:
+                continue
+            ts = nn.getTimestamp()
+            depth = min(self.streams["depth"], key=lambda m: abs(m.getTimestamp() - ts))
+            if self.THRESHOLD <= abs(depth.getTimestamp() - ts):
+                continue
+            synced = {"pass": frame, "depth": depth, "nn": nn}
+            # Remove synced and all older msgs, return synced msgs
+            for stream, msgs in self.streams.items():
+                synced_ts = synced[stream].getTimestamp()
+                while msgs and msgs[0].getTimestamp() <= synced_ts:
+                    msgs.popleft()
             return synced
         return False
 
@@ -100,6 +131,18 @@ def crop_to_square(frame):
 
 # Start defining a pipeline
 pipeline = dai.Pipeline()
+# Send each message in a single XLink write instead of 64kB chunks
+pipeline.setXLinkChunkSize(0)
+
+# On PoE devices use jumbo frames and delayed ACKs instead of TCP_NODELAY,
+# so large frames take less round-trips (and frames don't age on the way)
+found, device_info = dai.Device.getFirstAvailableDevice()
+if found and device_info.protocol == dai.XLinkProtocol.X_LINK_TCP_IP:
+    board = dai.BoardConfig()
+    board.network.mtu = 9000
+    board.network.xlinkTcpNoDelay = False
+    board.sysctl = ["net.inet.tcp.delayed_ack=1"]
+    pipeline.setBoardConfig(board)
 
 pipeline.setOpenVINOVersion(version=dai.OpenVINO.Version.VERSION_2021_2)
 
@@ -116,11 +159,6 @@ cam.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
 cam.setPreviewSize(nn_shape, nn_shape)
 cam.setInterleaved(False)
 
-# NN output linked to XLinkOut
-isp_xout = pipeline.create(dai.node.XLinkOut)
-isp_xout.setStreamName("cam")
-cam.isp.link(isp_xout.input)
-
 # Define a neural network that will make predictions based on the source frames
 detection_nn = pipeline.create(dai.node.NeuralNetwork)
 detection_nn.setBlobPath(nn_path)
@@ -133,6 +171,12 @@ xout_nn = pipeline.create(dai.node.XLinkOut)
 xout_nn.setStreamName("nn")
 detection_nn.out.link(xout_nn.input)
 
+# Frames the NN ran inference on (center-cropped preview) linked to XLinkOut.
+# They have the same sequence number as the NN results, so HostSync pairs them exactly
+xout_pass = pipeline.create(dai.node.XLinkOut)
+xout_pass.setStreamName("pass")
+detection_nn.passthrough.link(xout_pass.input)
+
 # Left mono camera
 left = pipeline.create(dai.node.MonoCamera)
 left.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
@@ -150,6 +194,11 @@ stereo.initialConfig.setMedianFilter(dai.StereoDepthProperties.MedianFilter.KERN
 # stereo.setSubpixel(True)
 stereo.setLeftRightCheck(True)
 stereo.setDepthAlign(dai.CameraBoardSocket.RGB)
+# Scale the RGB-aligned disparity down to 1024x576 (0.8x the 1280x720 ISP
+# frame, keeping its aspect ratio) on the device, so less is sent over XLink.
+# Its 576x576 center crop is still larger than TARGET_SHAPE, so the host only
+# ever downscales it
+stereo.setOutputSize(1024, 576)
 left.out.link(stereo.left)
 right.out.link(stereo.right)
 
@@ -158,73 +207,138 @@ xout_disp = pipeline.create(dai.node.XLinkOut)
 xout_disp.setStreamName("disparity")
 stereo.disparity.link(xout_disp.input)
 
-# Pipeline is defined, now we can connect to the device
-with dai.Device(pipeline.getOpenVINOVersion()) as device:
+# Pipeline is defined, now we can connect to the device. The pipeline is
+# passed here (instead of startPipeline) so the board config is applied on boot
+# If no device was found yet (eg. PoE device still booting), let DepthAI search for one
+with (dai.Device(pipeline, device_info) if found else dai.Device(pipeline)) as device:
     cams = device.getConnectedCameras()
     depth_enabled = dai.CameraBoardSocket.LEFT in cams and dai.CameraBoardSocket.RIGHT in cams
     if not depth_enabled:
         raise RuntimeError("Unable to run this experiment on device without depth capabilities! (Available cameras: {})".format(cams))
-    device.startPipeline(pipeline)
     # Output queues will be used to get the outputs from the device
-    q_color = device.getOutputQueue(name="cam", maxSize=4, blocking=False)
+    q_pass = device.getOutputQueue(name="pass", maxSize=4, blocking=False)
     q_disp = device.getOutputQueue(name="disparity", maxSize=4, blocking=False)
     q_nn = device.getOutputQueue(name="nn", maxSize=4, blocking=False)
 
     fps = FPSHandler()
     sync = HostSync()
-    disp_frame = None
-    disp_multiplier = 255 / stereo.initialConfig.getMaxDisparity()
-
-    frame = None
-    depth = None
-    depth_weighted = None
-    frames = {}
-
-    while True:
-        msgs = False
-        if q_color.has():
-            msgs = msgs or sync.add_msg("color", q_color.get())
-        if q_disp.has():
-            msgs = msgs or sync.add_msg("depth", q_disp.get())
-        if q_nn.has():
-            msgs = msgs or sync.add_msg("nn", q_nn.get())
-
-        if msgs:
+    # Maps every disparity value to 0..255 for visualization, applied as a
+    # single lookup instead of a float multiply + cast
+    max_disparity = int(stereo.initialConfig.getMaxDisparity())
+    disp_lut = np.clip(np.arange(max_disparity + 1) * (255 / max_disparity), 0, 255).astype(np.uint8)
+
+    # Per-frame buffers, allocated once and reused by every iteration
+    frame = np.empty((*TARGET_SHAPE, 3), dtype=np.uint8)
+    mask_big = np.empty(TARGET_SHAPE, dtype=np.uint8)
+    disp_u8 = np.empty(TARGET_SHAPE, dtype=np.uint8)
+
+    # Combined frames (colored frame | cutout | depth) are handed from the
+    # postprocessing thread to the GUI (main) thread. Only the latest one is
+    # kept in out_q, the rest of the buffers are in free_q (or being written
+    # to / shown). The cutout and depth are written straight into them
+    w = TARGET_SHAPE[0]
+    out_q = queue.Queue(maxsize=1)
+    free_q = queue.Queue()
+    show_buffers = [np.empty((TARGET_SHAPE[1], 3 * w, 3), dtype=np.uint8) for _ in range(3)]
+    for show in show_buffers:
+        free_q.put(show)
+    # Compile postprocess() now (on the real buffers) instead of on the first frame
+    postprocess(disp_u8, mask_big, jet_lut, frame, show_buffers[0][:, 2*w:], show_buffers[0][:, w:2*w])
+    running = threading.Event()
+    running.set()
+
+    # Queue callbacks are called from DepthAI threads as soon as a msg arrives.
+    # They only sync (O(1)) and hand the latest synced msgs to the producer
+    synced_q = queue.Queue(maxsize=1)
+    sync_lock = threading.Lock()
+    def add_msg(name, msg):
+        with sync_lock:
+            msgs = sync.add_msg(name, msg)
+            if msgs:
+                try:
+                    synced_q.get_nowait()
+                except queue.Empty:
+                    pass
+                synced_q.put_nowait(msgs)
+
+    q_pass.addCallback(lambda msg: add_msg("pass", msg))
+    q_disp.addCallback(lambda msg: add_msg("depth", msg))
+    q_nn.addCallback(lambda msg: add_msg("nn", msg))
+
+    def producer():
+        disp_resized = None # dtype depends on the disparity output, set by cv2.resize
+        frames = {}
+        while running.is_set():
+            try:
+                msgs = synced_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
             fps.next_iter()
-            # get layer1 data
-            layer1 = msgs['nn'].getFirstLayerInt32()
-            # reshape to numpy array
-            lay1 = np.asarray(layer1, dtype=np.int32).reshape((nn_shape, nn_shape))
-            output_colors = decode_deeplabv3p(lay1)
+            # get layer1 data as a zero-copy int32 view over the raw NN output
+            # (the model has a single output layer, so it starts at offset 0)
+            lay1 = np.frombuffer(msgs['nn'].getData(), dtype=np.int32, count=nn_shape * nn_shape)
+            mask = decode_deeplabv3p(lay1)
 
             # To match depth frames
-            output_colors = cv2.resize(output_colors, TARGET_SHAPE)
-
-            frame = msgs["color"].getCvFrame()
-            frame = crop_to_square(frame)
-            frame = cv2.resize(frame, TARGET_SHAPE)
-            frames['frame'] = frame
-            frame = cv2.addWeighted(frame, 1, output_colors,0.5,0)
-            cv2.putText(frame, "Fps: {:.2f}".format(fps.fps()), (2, frame.shape[0] - 4), cv2.FONT_HERSHEY_TRIPLEX, 0.4, color=(255, 255, 255))
-            frames['colored_frame'] = frame
-
-            disp_frame = msgs["depth"].getFrame()
-            disp_frame = (disp_frame * disp_multiplier).astype(np.uint8)
-            disp_frame = crop_to_square(disp_frame)
-            disp_frame = cv2.resize(disp_frame, TARGET_SHAPE)
-
-            # Colorize the disparity
-            frames['depth'] = cv2.applyColorMap(disp_frame, jet_custom)
-
-            multiplier = get_multiplier(lay1)
-            multiplier = cv2.resize(multiplier, TARGET_SHAPE)
-            depth_overlay = disp_frame * multiplier
-            frames['cutout'] = cv2.applyColorMap(depth_overlay, jet_custom)
+            cv2.resize(mask, TARGET_SHAPE, dst=mask_big, interpolation=cv2.INTER_NEAREST)
+
+            cv2.resize(msgs["pass"].getCvFrame(), TARGET_SHAPE, dst=frame)
+
+            disp_frame = crop_to_square(msgs["depth"].getFrame())
+            # Nearest, so invalid (0) disparities aren't blended into valid ones at edges
+            disp_resized = cv2.resize(disp_frame, TARGET_SHAPE, dst=disp_resized, interpolation=cv2.INTER_NEAREST)
+            # mode='clip': writes into disp_u8 without buffering and can't raise
+            # on disparities above max_disparity
+            np.take(disp_lut, disp_resized, out=disp_u8, mode='clip')
+
+            show = free_q.get()
+            frames['colored_frame'] = show[:, :w]
+            frames['cutout'] = show[:, w:2*w]
+            frames['depth'] = show[:, 2*w:]
+
+            # Colorize the disparity, cut it out and tint the frame
+            postprocess(disp_u8, mask_big, jet_lut, frame, frames['depth'], frames['cutout'])
+            frames['colored_frame'][:] = frame
+            fps.draw(frames['colored_frame'])
             # You can add custom code here, for example depth averaging
 
-        if len(frames) == 4:
-            show = np.concatenate((frames['colored_frame'], frames['cutout'], frames['depth']), axis=1)
+            # Drop the combined frame that wasn't shown yet, GUI only needs the latest one
+            try:
+                free_q.put(out_q.get_nowait())
+            except queue.Empty:
+                pass
+            out_q.put_nowait(show)
+
+    # producer() runs in a daemon thread, so pass its errors to the main thread
+    # (stopping the GUI loop) instead of leaving a frozen window behind
+    producer_errors = []
+    def run_producer():
+        try:
+            producer()
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            running.clear()
+
+    producer_thread = threading.Thread(target=run_producer, daemon=True)
+    producer_thread.start()
+
+    while running.is_set():
+        # Only redraw when a new combined frame arrived, but keep pumping GUI events
+        try:
+            show = out_q.get_nowait()
+        except queue.Empty:
+            show = None
+        if show is not None:
             cv2.imshow("Combined frame", show)
+            free_q.put(show)
 
         if cv2.waitKey(1) == ord('q'):
-            break
+            running.clear()
+
+    # Let producer() finish the current frame (its waits time out after 0.1s)
+    # before the device gets closed
+    producer_thread.join()
+    if producer_errors:
+        raise producer_errors[0]